@@ -37,9 +37,8 @@ SOFTWARE.
 
 from micropython import const
 from machine import Pin
+from array import array
 import time
-# ubinascii is only used for '#'-coding, feel free to disable if required
-import ubinascii
 
 # flip these two values if the LEDs are lit where they shouldn't be, and vice versa
 LIT = const(0b0)
@@ -48,8 +47,23 @@ UNLIT = const(0b1)
 # either '.' or ':'
 SEGMENT8 = const('.')
 
+# fonts are tables of glyphs indexed by ord(c), NOGLYPH marks a character that has none
+# (it's outside the byte range, so every glyph including 0xFF is still available)
+NOGLYPH = const(0x100)
+
+# turn a {character: glyph} dict into a font table, plus a dict of the characters past '\xff'
+def font_table(glyphs):
+    t = array('H', [NOGLYPH] * 256)
+    wide = {}
+    for c, g in glyphs.items():
+        if ord(c) < 256:
+            t[ord(c)] = g
+        else:
+            wide[c] = g
+    return t, wide
+
 # all my own work, inasmuch as there is any originality in a 7-segment font
-TINKER_FONT = {
+TINKER_FONT, TINKER_WIDE = font_table({
     # just a little bit of personality in the '7' 'J' 'T' 'Y' and 'Z'
     # some letters are unusual by necessity, particularly 'K' 'M' 'R' 'V' and 'W'
     '0': 0x3F, '1': 0x06, '2': 0x5B, '3': 0x4F, '4': 0x66,
@@ -68,11 +82,17 @@ TINKER_FONT = {
     # some lower-case options that I don't like, but maybe you do...
 #    'a': 0x5F,
 #    'g': 0x6F,
-}
+})
 
 BLANK = const(' ')
 UNDEF = const('_')
 
+# hex digit values by ord(c), for '#'-coding (0xFF if not a hex digit)
+_HEX = bytearray([0xFF] * 128)
+for _i in range(16):
+    _HEX[ord('0123456789ABCDEF'[_i])] = _HEX[ord('0123456789abcdef'[_i])] = _i
+del _i
+
 
 
 class Display:
@@ -80,55 +100,179 @@ class Display:
     sclk = None
     rclk = None
     dio = None
+    _sclk_v = None
+    _rclk_v = None
+    _dio_v = None
     _displays = None
     _font = None
+    _blank = None
+    _question_has_dot = False
+    _wide = None
 
-    def __init__(self, sclk, rclk, dio, displays=1, font=TINKER_FONT):
-        if not isinstance(sclk, Pin):
-            sclk = Pin(sclk, Pin.OUT)
-        self.sclk = sclk
+    def __init__(self, sclk, rclk, dio, displays=1, font=TINKER_FONT, wide=None):
+        mk = lambda p: p if isinstance(p, Pin) else Pin(p, Pin.OUT)
+        self.sclk, self.rclk, self.dio = mk(sclk), mk(rclk), mk(dio)
 
-        if not isinstance(rclk, Pin):
-            rclk = Pin(rclk, Pin.OUT)
-        self.rclk = rclk
-
-        if not isinstance(dio, Pin):
-            dio = Pin(dio, Pin.OUT)
-        self.dio = dio
+        # bound once, so the viper code doesn't look them up for every bit
+        self._sclk_v = self.sclk.value
+        self._rclk_v = self.rclk.value
+        self._dio_v = self.dio.value
 
         if isinstance(displays, int):
-            d = []
-            for i in range(displays):
-                d.append(1<<(displays-i-1))
-            displays = d
-        self._displays = tuple(displays)
-
-        self._font = font #ATTN: no .copy()
+            displays = (1 << i for i in range(displays-1, -1, -1))
+        self._displays = array('I', displays)
+
+        # scroll() always uses the displays in bit order, and only refreshes what's in the window
+        n = len(self._displays)
+        self._scroll_masks = array('I', (1 << i for i in range(n-1, -1, -1)))
+        self._scroll_window = bytearray(n)
+
+        # a dict still works, but is converted (so later changes to it aren't seen)
+        # `wide` is for characters past the end of the table, and comes from the dict if there is one
+        if isinstance(font, dict):
+            font, wide = font_table(font)
+        elif wide is None and font is TINKER_FONT:
+            wide = TINKER_WIDE
+        self._font = font #ATTN: tables are not copied
+        self._wide = wide if wide is not None else {}
+        for c in (BLANK, UNDEF):
+            if c is not None and (ord(c) >= len(font) or font[ord(c)] == NOGLYPH):
+                raise KeyError(c)
+        self._blank = font[ord(BLANK)]
+        # the default '?' has no room for a dot, so it puts one on the character before instead
+        self._question_has_dot = ord('?') < len(font) and font[ord('?')] == 0x53 and SEGMENT8 == '.'
 
 
 
     # ~50% speed-up with viper, so brighter LEDs and less flickering
     @micropython.viper
-    def _update_displays(self, b:uint, d:uint):
-        m = uint(0b10000000)
-        while m != uint(0):
-            self.dio.value(LIT if b & m else UNLIT)
-            self.sclk.value(0)
-            self.sclk.value(1)
-            m >>= 1
-        m = uint(0b10000000)
-        while m != uint(0):
-            self.dio.value(1 if d & m else 0) # 1/0 not LIT/UNLIT
-            self.sclk.value(0)
-            self.sclk.value(1)
-            m >>= 1
-        self.rclk.value(0)
-        self.rclk.value(1)
+    def _update_displays(self, b:uint, d:uint, f:uint):
+        sv = self._sclk_v
+        rv = self._rclk_v
+        dv = self._dio_v
+        b &= f # `f` is the fade mask
+        # unrolled and branchless, bit 7 first
+        dv(((b >> 7) & 1) ^ UNLIT)
+        sv(0)
+        sv(1)
+        dv(((b >> 6) & 1) ^ UNLIT)
+        sv(0)
+        sv(1)
+        dv(((b >> 5) & 1) ^ UNLIT)
+        sv(0)
+        sv(1)
+        dv(((b >> 4) & 1) ^ UNLIT)
+        sv(0)
+        sv(1)
+        dv(((b >> 3) & 1) ^ UNLIT)
+        sv(0)
+        sv(1)
+        dv(((b >> 2) & 1) ^ UNLIT)
+        sv(0)
+        sv(1)
+        dv(((b >> 1) & 1) ^ UNLIT)
+        sv(0)
+        sv(1)
+        dv((b & 1) ^ UNLIT)
+        sv(0)
+        sv(1)
+        dv((d >> 7) & 1) # 1/0 not LIT/UNLIT
+        sv(0)
+        sv(1)
+        dv((d >> 6) & 1)
+        sv(0)
+        sv(1)
+        dv((d >> 5) & 1)
+        sv(0)
+        sv(1)
+        dv((d >> 4) & 1)
+        sv(0)
+        sv(1)
+        dv((d >> 3) & 1)
+        sv(0)
+        sv(1)
+        dv((d >> 2) & 1)
+        sv(0)
+        sv(1)
+        dv((d >> 1) & 1)
+        sv(0)
+        sv(1)
+        dv(d & 1)
+        sv(0)
+        sv(1)
+        rv(0)
+        rv(1)
+
+
+
+    # one refresh of every position, `glyphs[i] & f` goes to `masks[i]` (skipped if 0)
+    # this is _update_displays inlined into the loop, so a whole pass is one native call
+    @micropython.viper
+    def _refresh_all(self, glyphs:ptr8, masks:ptr32, n:int, f:uint):
+        sv = self._sclk_v
+        rv = self._rclk_v
+        dv = self._dio_v
+        i = 0
+        while i < n:
+            d = uint(masks[i])
+            if d:
+                b = uint(glyphs[i]) & f
+                dv(((b >> 7) & 1) ^ UNLIT)
+                sv(0)
+                sv(1)
+                dv(((b >> 6) & 1) ^ UNLIT)
+                sv(0)
+                sv(1)
+                dv(((b >> 5) & 1) ^ UNLIT)
+                sv(0)
+                sv(1)
+                dv(((b >> 4) & 1) ^ UNLIT)
+                sv(0)
+                sv(1)
+                dv(((b >> 3) & 1) ^ UNLIT)
+                sv(0)
+                sv(1)
+                dv(((b >> 2) & 1) ^ UNLIT)
+                sv(0)
+                sv(1)
+                dv(((b >> 1) & 1) ^ UNLIT)
+                sv(0)
+                sv(1)
+                dv((b & 1) ^ UNLIT)
+                sv(0)
+                sv(1)
+                dv((d >> 7) & 1) # 1/0 not LIT/UNLIT
+                sv(0)
+                sv(1)
+                dv((d >> 6) & 1)
+                sv(0)
+                sv(1)
+                dv((d >> 5) & 1)
+                sv(0)
+                sv(1)
+                dv((d >> 4) & 1)
+                sv(0)
+                sv(1)
+                dv((d >> 3) & 1)
+                sv(0)
+                sv(1)
+                dv((d >> 2) & 1)
+                sv(0)
+                sv(1)
+                dv((d >> 1) & 1)
+                sv(0)
+                sv(1)
+                dv(d & 1)
+                sv(0)
+                sv(1)
+                rv(0)
+                rv(1)
+            i += 1
 
 
 
     def _clear_displays(self, displays):
-        self._update_displays(self._font[BLANK], displays)
+        self._update_displays(self._blank, displays, 0b11111111)
 
     def clear(self, duration=0):
         self._clear_displays(-1)
@@ -138,52 +282,77 @@ class Display:
 
     # do the font lookup to turn text into a bunch of LED values
     # `padding` can add blanks before and after (useful for a scroller)
+    @micropython.native
     def encode(self, text, padding=0):
+        font = self._font
+        wide = self._wide
+        nfont = len(font)
+        qdot = self._question_has_dot
+        L = len(text)
         if padding is True:
             padding = len(self._displays)
-        if padding > 0:
-            text = (BLANK * padding) + text + (BLANK * padding)
-
-        result = []
+        if padding < 0:
+            padding = 0
+
+        blank = self._blank
+        undef = font[ord(UNDEF)] if UNDEF is not None else None # None means drop unknown characters
+        # never more than one byte per character, plus the padding at each end
+        result = bytearray(L + 2 * padding)
+        k = 0
+        for _ in range(padding):
+            result[k] = blank
+            k += 1
         i = 0
-        while i < len(text):
-            try:
-                c = text[i]
-                if c == SEGMENT8:
-                    if i:
-                        result[-1] |= 0b10000000
-                elif c == '#':
-                    if text[i+1] == '#':
-                        i += 1
-                        result.append(self._font['#'])
-                    else:
-                        i += 2
-                        result.append(ubinascii.unhexlify(text[i-1:i+1])[0])
-                elif c == '?' and '?' in self._font and self._font['?'] == 0x53 and SEGMENT8 == '.':
-                    if i:
-                        result[-1] |= 0b10000000
-                    result.append(self._font[c])
-                else:
-                    result.append(self._font[c])
-            except:
-                if UNDEF is not None:
-                    result.append(self._font[UNDEF])
+        while i < L:
+            c = text[i]
+            if c == SEGMENT8:
+                if k:
+                    result[k-1] |= 0b10000000
+                i += 1
+                continue
+            if c == '#' and not (i + 1 < L and text[i+1] == '#'):
+                b = undef
+                if i + 2 < L:
+                    hi = ord(text[i+1])
+                    lo = ord(text[i+2])
+                    if hi < 128 and lo < 128 and (_HEX[hi] | _HEX[lo]) < 16:
+                        b = (_HEX[hi] << 4) | _HEX[lo]
+                i += 2 # a bad code still swallows the two characters after the '#'
+            else:
+                if c == '#':
+                    i += 1 # '##' is a literal '#'
+                elif c == '?' and qdot:
+                    if k:
+                        result[k-1] |= 0b10000000
+                o = ord(c)
+                b = font[o] if o < nfont else wide.get(c, NOGLYPH)
+                if b == NOGLYPH:
+                    b = undef
+            if b is not None:
+                result[k] = b
+                k += 1
             i += 1
-        return tuple(result)
+        for _ in range(padding):
+            result[k] = blank
+            k += 1
+        return result[:k]
 
 
     # set multiple displays (default: all of them) to show the same thing
     # if `msg` is more than one character, it will run through them all
+    @micropython.native
     def blast(self, msg, displays=-1, duration=1, clear=None): # that is duration *per character*
+        upd = self._update_displays
+        sleep = time.sleep
         if isinstance(msg, str):
             msg = self.encode(msg)
         if clear is None:
             clear = bool(len(msg)>1)
 
         for i in range(len(msg)):
-            self._update_displays(msg[i], displays)
+            upd(msg[i], displays, 0b11111111)
             if duration > 0:
-                time.sleep(duration)
+                sleep(duration)
 
         if clear:
             self._clear_displays(displays)
@@ -193,32 +362,28 @@ class Display:
     def print(self, msg, pos=0, duration=1, fade=(0b11111111,), clear=None):
         if isinstance(msg, str):
             msg = self.encode(msg)
+        elif not isinstance(msg, (bytes, bytearray)):
+            msg = bytes(b & 0xFF for b in msg) # _refresh_all needs a buffer, and only 8 bits are shown anyway
+        N = len(self._displays)
+        M = len(msg)
         if clear is None:
-            clear = bool(len(msg)>1)
+            clear = bool(M>1)
 
+        # work out which display each character goes to, once, rather than on every refresh
+        start = pos if pos >= 0 else N - M + pos + 1
+        positions = array('I', [self._displays[start+i] if 0 <= start+i < N else 0 for i in range(M)])
         used_displays = 0
+        for d in positions:
+            used_displays |= d
 
-        for f in fade:
-            t0 = time.ticks_ms()
-            while True:
-                for i in range(len(msg)):
-                    displays = 0
-                    if pos >= 0:
-                        j = pos + i
-                        try: displays = self._displays[j]
-                        except IndexError: break # slight optimisation over 'pass'
-                    else:
-                        j = len(self._displays) - len(msg) + pos + i + 1
-                        if j >= 0:
-                            try: displays = self._displays[j]
-                            except IndexError: pass
-                    if displays:
-                        if duration > 0:
-                            self._update_displays(msg[i] & f, displays)
-                        used_displays |= displays
-                t = time.ticks_ms()
-                if not (duration > 0) or (t - t0 >= duration * 1000) or (t < t0):
-                    break
+        if duration > 0:
+            ms = int(duration * 1000)
+            for f in fade:
+                deadline = time.ticks_add(time.ticks_ms(), ms)
+                while True:
+                    self._refresh_all(msg, positions, M, f)
+                    if time.ticks_diff(time.ticks_ms(), deadline) >= 0:
+                        break
 
         if clear and used_displays:
             self._clear_displays(used_displays)
@@ -228,77 +393,77 @@ class Display:
 
     #
     def vbars(self, n, duration=1):
+        # two bars per display, to the nearest half bar (the 0.002 is slack for float error)
+        full, part = divmod(int(abs(n) * 2 + 0.002), 4)
+        msg = bytearray([0x36] * full)
         if n >= 0:
-            msg = ''
-            while n > 1.999:
-                msg = msg + '#36'
-                n -= 2
-            if n > 1.499:
-                msg = msg + '#32'
-            elif n > 0.999:
-                msg = msg + '#30'
-            elif n > 0.499:
-                msg = msg + '#20'
+            if part:
+                msg.append((0, 0x20, 0x30, 0x32)[part])
             self.print(msg, duration=duration, clear=True)
         else:
-            n = -n
-            msg = ''
-            while n > 1.999:
-                msg = '#36' + msg
-                n -= 2
-            if n > 1.499:
-                msg = '#16' + msg
-            elif n > 0.999:
-                msg = '#06' + msg
-            elif n > 0.499:
-                msg = '#04' + msg
+            if part:
+                msg = bytearray(((0, 0x04, 0x06, 0x16)[part],)) + msg
             self.print(msg, pos=-1, duration=duration, clear=True)
 
 
     #
+    @micropython.native
     def flash(self, msg, pos=0, on=0.5, off=0.5, count=3):
+        prt = self.print
+        sleep = time.sleep
         if isinstance(msg, str):
             msg = self.encode(msg)
         self.clear()
         for _ in range(count):
-            self.print(msg, pos, duration=on, clear=True)
-            time.sleep(off)
+            prt(msg, pos, duration=on, clear=True)
+            sleep(off)
 
 
 
     _scroll_encoded = None
     _scroll_cursor = 0
+    _scroll_masks = None
+    _scroll_window = None
+
+    # copy the visible part of the message, only needed when the cursor moves
+    def _scroll_fill(self):
+        enc = self._scroll_encoded
+        L = len(enc)
+        cur = self._scroll_cursor
+        window = self._scroll_window
+        for i in range(len(window)):
+            window[i] = enc[(cur + i) % L]
 
     def scroll_init(self, msg, start=0):
         if isinstance(msg, str):
             msg = self.encode(msg)
-        while len(msg) < len(self._displays):
-            msg.insert(0, self._font[BLANK])
+        if len(msg) < len(self._displays):
+            msg = bytearray([self._blank] * (len(self._displays) - len(msg))) + bytearray(msg)
         self._scroll_encoded = msg
         if start >= 0:
             self._scroll_cursor = start
         else:
             self._scroll_cursor = len(msg) - len(self._displays) + start + 1
+        self._scroll_fill()
 
     def scroll(self, amount=+1, duration=1):
-        t0 = time.ticks_ms()
-        while True:
-            for i in range(len(self._displays)):
-                try: b = self._scroll_encoded[(self._scroll_cursor + i) % len(self._scroll_encoded)]
-                except IndexError: break
-                if duration > 0:
-                    self._update_displays(b, 1<<(len(self._displays) - 1 - i))
-            t = time.ticks_ms()
-            if not (duration > 0) or (t - t0 >= duration * 1000) or (t < t0):
-                break
+        N = len(self._displays)
+        L = len(self._scroll_encoded)
+        cur = self._scroll_cursor
+        if duration > 0:
+            window = self._scroll_window
+            masks = self._scroll_masks
+            deadline = time.ticks_add(time.ticks_ms(), int(duration * 1000))
+            while True:
+                self._refresh_all(window, masks, N, 0b11111111)
+                if time.ticks_diff(time.ticks_ms(), deadline) >= 0:
+                    break
         self.clear()
 
-        if (self._scroll_cursor + amount + len(self._displays)) <= len(self._scroll_encoded) and self._scroll_cursor + amount >= 0:
-            self._scroll_cursor = (self._scroll_cursor + amount) % len(self._scroll_encoded)
-            return True
-        else:
-            self._scroll_cursor = (self._scroll_cursor + amount) % len(self._scroll_encoded)
-            return False
+        more = (cur + amount + N) <= L and cur + amount >= 0
+        self._scroll_cursor = (cur + amount) % L
+        self._scroll_fill()
+        return more
 
 
 